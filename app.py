@@ -7,20 +7,51 @@
 # PyMuPDF==1.24.6
 # gunicorn==22.0.0
 # boto3==1.34.162  # only if USE_S3=true
-
-import io, os, uuid, base64, traceback
+# pybase64==1.4.0  # optional, faster signature decoding
+# orjson==3.10.7  # optional, faster JSON in and out
+
+import io, os, gzip, json, time, uuid, binascii, hashlib, shutil, traceback, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime
+from itertools import groupby
 from pathlib import Path
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, Response, request, jsonify, redirect, send_file, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 import fitz  # PyMuPDF
+try:
+    import pybase64  # SIMD base64; binascii is the fallback
+except ImportError:
+    pybase64 = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import fcntl  # POSIX only; reflink clones and the cross-process doc lock
+except ImportError:
+    fcntl = None
 
 load_dotenv()
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET", "dev-secret")
 app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100 MB
 
+if orjson is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """jsonify and request parsing through orjson; the stdlib provider stays the fallback."""
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+
 BASE_DIR = Path(__file__).resolve().parent
 WORK_DIR = Path(os.getenv("WORK_DIR", BASE_DIR / "work"))
 WORK_DIR.mkdir(parents=True, exist_ok=True)
@@ -30,35 +61,424 @@ ALLOWED_EXT = {".pdf"}
 USE_S3 = os.getenv("USE_S3", "false").lower() == "true"
 if USE_S3:
     import boto3
+    from boto3.s3.transfer import TransferConfig
     S3_BUCKET = os.getenv("S3_BUCKET")
     S3_REGION = os.getenv("S3_REGION")
     s3 = boto3.client("s3", region_name=S3_REGION)
+    # big PDFs go up/down as concurrent 8 MB parts instead of one single-stream request
+    S3_TRANSFER = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=8, use_threads=True)
 else:
-    s3, S3_BUCKET = None, None
-
-DOCS = {}  # {doc_id: {name, original, working, versions[], created}}
+    s3, S3_BUCKET, S3_TRANSFER = None, None, None
+
+DOCS = OrderedDict()  # {doc_id: (meta.json stamp, {name, original, working, versions[], created})}, LRU
+DOCS_MAX = int(os.getenv("DOCS_MAX", "256"))
+_DOCS_LOCK = threading.Lock()
+_DOC_LOCKS = [threading.Lock() for _ in range(64)]  # striped: bounded, and never outlives a doc it guards
+MAX_VERSIONS = int(os.getenv("MAX_VERSIONS", "20"))
+# Full-save options. garbage=1 only drops unreferenced objects; 3 also hunts for duplicate
+# objects, which costs a compare pass over the whole file for little gain on annotated copies.
+PDF_SAVE_OPTS = dict(deflate=True, deflate_images=True, deflate_fonts=True, garbage=1, clean=False)
+
+DOC_CACHE_MAX = int(os.getenv("DOC_CACHE_MAX", "32"))
+DOC_CACHE_PAGES = int(os.getenv("DOC_CACHE_PAGES", "5000"))  # open-page budget; page trees are what cost memory
+_DOC_CACHE = OrderedDict()  # {working_key: (fitz.Document, lock, page_count)}, LRU order
+_DOC_CACHE_LOCK = threading.Lock()
+_DOC_CACHE_USED = {}  # {working_key: time.monotonic() of last use}
+DOC_CACHE_IDLE = int(os.getenv("DOC_CACHE_IDLE", "3600"))  # s before an unused document is closed; 0 = never
+MUPDF_STORE_SHRINK = int(os.getenv("MUPDF_STORE_SHRINK", "50"))  # % of MuPDF's store freed after bulk work; 0 = off
+S3_SPOOL_MAX = int(os.getenv("S3_SPOOL_MAX", "64"))  # S3 objects kept on local disk so MuPDF can open them by path
+_SPOOL = OrderedDict()  # {spool path: None}, LRU order
+_SPOOL_PID = None  # process whose spool directory has been set up (workers fork after import)
+_SPOOL_LOCK = threading.Lock()
 
 # ───────── Storage ─────────
+FICLONE = 0x40049409  # Linux ioctl: share extents copy-on-write (btrfs, XFS, bcachefs)
+
+def _fast_copy(src, dst):
+    """Copy a file as a reflink where the filesystem supports it, else byte for byte."""
+    if fcntl is not None:
+        with open(src, "rb") as fi, open(dst, "wb") as fo:
+            try:
+                fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+                return
+            except OSError:  # not supported here, or across filesystems
+                pass
+    shutil.copyfile(src, dst)
+
 class Storage:
     @staticmethod
-    def save(file_bytes: bytes, key: str) -> str:
+    def save(file_bytes: bytes, key: str, content_type: str = "application/pdf") -> str:
+        if USE_S3:
+            s3.upload_fileobj(io.BytesIO(file_bytes), S3_BUCKET, key, Config=S3_TRANSFER,
+                              ExtraArgs={"ContentType": content_type})
+            return key
+        p = WORK_DIR / key
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(f"{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(file_bytes)
+        os.replace(tmp, p)  # meta.json is rewritten in place; other workers must never read half of it
+        return key
+
+    @staticmethod
+    def save_stream(src, key: str, content_type: str = "application/pdf") -> str:
+        """Copy a file-like object to `key` in chunks, never holding the whole body."""
         if USE_S3:
-            s3.put_object(Bucket=S3_BUCKET, Key=key, Body=file_bytes, ContentType="application/pdf")
+            s3.upload_fileobj(src, S3_BUCKET, key, Config=S3_TRANSFER, ExtraArgs={"ContentType": content_type})
             return key
         p = WORK_DIR / key
         p.parent.mkdir(parents=True, exist_ok=True)
-        p.write_bytes(file_bytes)
+        tmp = p.with_name(f"{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp, "wb") as out:
+                shutil.copyfileobj(src, out, 1 << 20)
+            os.replace(tmp, p)  # a dropped or oversize upload never leaves a partial file at `key`
+        finally:
+            tmp.unlink(missing_ok=True)
+        return key
+
+    @staticmethod
+    def save_pdf(pdf: fitz.Document, key: str) -> str:
+        """Write a document straight to its key, without a bytes round-trip."""
+        if USE_S3:
+            out = io.BytesIO()
+            pdf.save(out, **PDF_SAVE_OPTS)
+            out.seek(0)
+            s3.upload_fileobj(out, S3_BUCKET, key, Config=S3_TRANSFER, ExtraArgs={"ContentType": "application/pdf"})
+            return key
+        p = WORK_DIR / key
+        p.parent.mkdir(parents=True, exist_ok=True)
+        pdf.save(str(p), **PDF_SAVE_OPTS)
         return key
 
     @staticmethod
     def get(key: str) -> bytes:
         if USE_S3:
-            obj = s3.get_object(Bucket=S3_BUCKET, Key=key)
-            return obj["Body"].read()
+            buf = io.BytesIO()
+            s3.download_fileobj(S3_BUCKET, key, buf, Config=S3_TRANSFER)
+            return buf.getvalue()
+        return Storage.path(key).read_bytes()
+
+    @staticmethod
+    def path(key: str):
+        """Local filesystem path for a key, or None when the backend is remote."""
+        if USE_S3:
+            return None
         p = Path(key)
-        if not p.is_absolute():
-            p = WORK_DIR / key
-        return p.read_bytes()
+        return p if p.is_absolute() else WORK_DIR / key
+
+    @staticmethod
+    def _spool_path(key: str) -> Path:
+        # per process: each worker's LRU deletes files, which must never be another worker's
+        return WORK_DIR / f"spool-{os.getpid()}" / f"{hashlib.sha1(key.encode()).hexdigest()}.pdf"
+
+    @staticmethod
+    def _spool_dir_ready(d: Path):
+        """Create this process's spool directory, clearing ones left by workers that have exited."""
+        global _SPOOL_PID
+        if _SPOOL_PID == os.getpid():
+            return
+        for old in WORK_DIR.glob("spool-*"):
+            try:
+                os.kill(int(old.name[6:]), 0)
+            except ProcessLookupError:
+                shutil.rmtree(old, ignore_errors=True)
+            except (ValueError, OSError):
+                pass
+        d.mkdir(parents=True, exist_ok=True)
+        _SPOOL.clear()  # a forked child inherits the parent's entries, not its directory
+        _SPOOL_PID = os.getpid()
+
+    @staticmethod
+    def spool(key: str) -> Path:
+        """Local copy of a remote key, downloaded once. Keys are never rewritten, so copies never go stale."""
+        p = Storage._spool_path(key)
+        Storage._spool_dir_ready(p.parent)
+        if not p.exists():
+            tmp = p.with_name(f"{uuid.uuid4().hex}.tmp")
+            s3.download_file(S3_BUCKET, key, str(tmp), Config=S3_TRANSFER)
+            os.replace(tmp, p)
+        with _SPOOL_LOCK:
+            _SPOOL[p] = None
+            _SPOOL.move_to_end(p)
+            while len(_SPOOL) > S3_SPOOL_MAX:
+                _SPOOL.popitem(last=False)[0].unlink(missing_ok=True)  # open documents keep their inode
+        return p
+
+    @staticmethod
+    def link(src: str, dst: str) -> str:
+        """Expose `src` under `dst` without copying bytes; returns the key to use.
+
+        Stored versions are never modified in place, so sharing them is safe.
+        """
+        if USE_S3:
+            return src
+        try:
+            os.link(Storage.path(src), Storage.path(dst))
+        except OSError:
+            _fast_copy(Storage.path(src), Storage.path(dst))
+        return dst
+
+    @staticmethod
+    def delete(key: str):
+        if USE_S3:
+            s3.delete_object(Bucket=S3_BUCKET, Key=key)
+            p = Storage._spool_path(key)
+            with _SPOOL_LOCK:
+                _SPOOL.pop(p, None)
+            p.unlink(missing_ok=True)
+            return
+        Storage.path(key).unlink(missing_ok=True)
+
+# ───────── Doc index ─────────
+# meta.json next to the PDFs is the source of truth; DOCS only keeps the most recently
+# used records so memory stays flat. Locally every lookup revalidates the cached record
+# against meta.json's stamp and writers hold an flock, so several worker processes can
+# share WORK_DIR. S3 has no cheap stamp or lock: writes and stale-version misses re-read
+# meta.json, but concurrent saves to one doc from different processes can still race.
+def _meta_key(doc_id: str) -> str:
+    return f"{doc_id}/meta.json"
+
+@contextmanager
+def _doc_lock(doc_id: str):
+    """Serialises read-modify-write of one doc's versions (annotate, revert), in this process and,
+    on local disk, against other workers sharing WORK_DIR."""
+    i = binascii.crc32(doc_id.encode()) % len(_DOC_LOCKS)  # hash() differs per process; crc32 doesn't
+    with _DOC_LOCKS[i]:
+        if fcntl is None or USE_S3:
+            yield
+            return
+        (WORK_DIR / ".locks").mkdir(exist_ok=True)
+        with open(WORK_DIR / ".locks" / f"{i}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # released when the file closes
+            yield
+
+def _meta_stamp(doc_id: str):
+    """Identity of the current local meta.json (each write is a new inode), or None on S3."""
+    p = Storage.path(_meta_key(doc_id))
+    if p is None:
+        return None
+    st = p.stat()
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+def _remember(doc_id: str, doc: dict, stamp):
+    with _DOCS_LOCK:
+        DOCS[doc_id] = (stamp, doc)
+        DOCS.move_to_end(doc_id)
+        while len(DOCS) > DOCS_MAX:
+            DOCS.popitem(last=False)
+
+def _load_doc(doc_id: str, fresh: bool = False):
+    """The doc's record, or None. `fresh` always re-reads meta.json (S3 can't revalidate cheaply)."""
+    try:
+        if str(uuid.UUID(doc_id)) != doc_id:
+            return None
+        stamp = _meta_stamp(doc_id)
+    except (ValueError, OSError):
+        return None
+    with _DOCS_LOCK:
+        hit = DOCS.get(doc_id)
+    if hit is not None and not fresh and hit[0] == stamp:
+        _remember(doc_id, hit[1], stamp)
+        return hit[1]
+    try:
+        doc = json.loads(Storage.get(_meta_key(doc_id)))
+    except Exception:
+        return None
+    _remember(doc_id, doc, stamp)
+    return doc
+
+def _save_doc(doc_id: str, doc: dict):
+    Storage.save(json.dumps(doc).encode(), _meta_key(doc_id), content_type="application/json")
+    _remember(doc_id, doc, _meta_stamp(doc_id))
+
+def _doc_copy(doc: dict) -> dict:
+    """Private copy of a record to edit; readers keep the published one until _save_doc swaps it."""
+    doc = dict(doc, versions=list(doc["versions"]), page_prev=dict(doc.get("page_prev", {})))
+    if "page_tags" in doc:
+        doc["page_tags"] = list(doc["page_tags"])
+    return doc
+
+def _drop_version(doc: dict, key: str):
+    """Delete a version's file; only once a record without it is published, so no reader resolves to it."""
+    _evict_pdf(key)
+    if key != doc["original"]:
+        Storage.delete(key)
+
+# ───────── Document cache ─────────
+# Working keys are never rewritten in place (annotate writes a new key), so a
+# parsed fitz.Document can be reused for as long as its key is current, provided
+# nothing ever edits a cached handle.
+def _open_pdf(key: str) -> fitz.Document:
+    # by path, so MuPDF reads the file itself instead of copying a bytes buffer
+    return fitz.open(str(Storage.path(key) or Storage.spool(key)))
+
+def _close_entry(entry):
+    pdf, lock, _ = entry
+    with lock:
+        pdf.close()
+
+@contextmanager
+def _cached_pdf(key: str):
+    """Yield the parsed document for `key`, holding its lock (fitz is not thread-safe).
+
+    Read-only: renders of this version share the handle and cache their output for good, so
+    anything that edits a document (annotate) must open its own handle instead.
+    """
+    while True:
+        with _DOC_CACHE_LOCK:
+            entry = _DOC_CACHE.get(key)
+            if entry is not None:
+                _DOC_CACHE.move_to_end(key)
+                _DOC_CACHE_USED[key] = time.monotonic()
+        if entry is None:
+            pdf = _open_pdf(key)
+            evicted = []
+            with _DOC_CACHE_LOCK:
+                entry = _DOC_CACHE.setdefault(key, (pdf, threading.RLock(), pdf.page_count))
+                _DOC_CACHE_USED[key] = time.monotonic()
+                while len(_DOC_CACHE) > 1 and (len(_DOC_CACHE) > DOC_CACHE_MAX or
+                                               sum(e[2] for e in _DOC_CACHE.values()) > DOC_CACHE_PAGES):
+                    old_key, old = _DOC_CACHE.popitem(last=False)
+                    _DOC_CACHE_USED.pop(old_key, None)
+                    evicted.append(old)
+            if entry[0] is not pdf:
+                pdf.close()
+            for old in evicted:
+                _close_entry(old)
+        pdf, lock, _ = entry
+        with lock:
+            if not pdf.is_closed:  # lost a race with _evict_pdf; reopen
+                yield pdf
+                return
+
+def _evict_pdf(key: str):
+    with _DOC_CACHE_LOCK:
+        entry = _DOC_CACHE.pop(key, None)
+        _DOC_CACHE_USED.pop(key, None)
+    if entry is not None:
+        _close_entry(entry)
+
+def _sweep_idle_pdfs():
+    """Close documents nobody has touched for DOC_CACHE_IDLE seconds, so a quiet worker gives memory back."""
+    while True:
+        time.sleep(min(DOC_CACHE_IDLE, 60))
+        cutoff = time.monotonic() - DOC_CACHE_IDLE
+        with _DOC_CACHE_LOCK:
+            stale = [k for k, t in _DOC_CACHE_USED.items() if t < cutoff]
+            for key in stale:
+                del _DOC_CACHE_USED[key]
+            stale = [e for e in (_DOC_CACHE.pop(k, None) for k in stale) if e is not None]
+        for entry in stale:
+            _close_entry(entry)
+        if stale:
+            _shrink_store()
+
+if DOC_CACHE_IDLE > 0:
+    threading.Thread(target=_sweep_idle_pdfs, name="doc-sweep", daemon=True).start()
+
+def _shrink_store():
+    """Free part of MuPDF's global image/font store, which otherwise only grows.
+
+    PyMuPDF 1.24 has no way to set the store's ceiling, so it is trimmed after saves and
+    thumbnail sweeps instead; the renders themselves are cached on disk.
+    """
+    if MUPDF_STORE_SHRINK > 0:
+        fitz.TOOLS.store_shrink(MUPDF_STORE_SHRINK)
+
+# ───────── Render cache ─────────
+RENDER_CACHE_KEEP = 3  # versions per doc whose renders stay on disk
+THUMB_WIDTH = 200      # px; the sidebar never shows thumbs wider than this
+THUMB_QUALITY = 60
+PAGE_QUALITY = 80
+RENDER_MAX_PIXELS = int(os.getenv("RENDER_MAX_PIXELS", "20000000"))  # bigger renders are scaled down to fit
+# PyMuPDF keeps the GIL while rasterising, so extra render threads only add memory and contention;
+# cap how many renders (pixmap + JPEG encode) run at once and let the rest queue.
+_RENDER_SLOTS = threading.BoundedSemaphore(int(os.getenv("RENDER_WORKERS", "2")))
+# one shared pool for upload-time thumbnail sweeps instead of a thread per upload
+_WARM_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("THUMB_WORKERS", "2")), thread_name_prefix="thumbs")
+_WARMING = {}  # {doc_id: threading.Event}; set() cancels that doc's sweep
+_WARMING_LOCK = threading.Lock()
+_PREFETCH_SLOTS = threading.BoundedSemaphore(int(os.getenv("PREFETCH_MAX", "2")))  # queued neighbour renders
+# its own worker, so page prefetches don't queue behind a whole-document thumbnail sweep
+_PREFETCH_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+def _render_cached(doc_id: str, key: str, page: int, quality: int, dpi: int = 72, width: int = None, tag: str = None):
+    """JPEG render of `page` in version `key`, made once and kept on disk. None for a bad page.
+
+    `width` (px) overrides `dpi` so the output is that wide whatever the page size.
+    `tag` names the file instead of the version, for renders addressed by page content.
+    """
+    size = f"w{width}" if width else dpi
+    path = WORK_DIR / doc_id / "cache" / f"{tag or _ver(key)}_{page}_{size}_{quality}.jpg"
+    if path.exists():
+        return path
+    with _RENDER_SLOTS:
+        if path.exists():  # rendered by whoever held the slot before us
+            return path
+        with _cached_pdf(key) as pdf:
+            if not (0 <= page < len(pdf)):
+                return None
+            pg = pdf[page]
+            zoom = width / max(pg.rect.width, 1) if width else dpi / 72.0
+            area = pg.rect.width * pg.rect.height * zoom * zoom
+            if area > RENDER_MAX_PIXELS:  # huge pages at high zoom would pin hundreds of MB per pixmap
+                zoom *= (RENDER_MAX_PIXELS / area) ** 0.5
+            pix = pg.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{uuid.uuid4().hex}.tmp")
+        pix.save(str(tmp), output="jpg", jpg_quality=quality)
+        os.replace(tmp, path)  # readers never see a half-written file
+    return path
+
+def _warm_thumbs(doc_id: str, key: str, cancel: threading.Event):
+    """Render every thumbnail of `key` ahead of the viewer asking; /thumb still renders on a miss."""
+    try:
+        with _cached_pdf(key) as pdf:
+            n = len(pdf)
+        for pno in range(n):
+            if cancel.is_set() or _render_cached(doc_id, key, pno, THUMB_QUALITY, width=THUMB_WIDTH) is None:
+                return
+        _shrink_store()
+    except Exception as e:
+        app.logger.warning("Thumbnail warm-up failed for %s: %s", doc_id, e)
+    finally:
+        with _WARMING_LOCK:
+            if _WARMING.get(doc_id) is cancel:  # a newer sweep for this doc keeps its entry
+                del _WARMING[doc_id]
+
+def _prefetch_page(doc_id: str, key: str, page: int, dpi: int):
+    try:
+        _render_cached(doc_id, key, page, PAGE_QUALITY, dpi=dpi)
+    except Exception as e:
+        app.logger.warning("Prefetch of %s page %s failed: %s", doc_id, page, e)
+    finally:
+        _PREFETCH_SLOTS.release()
+
+def _prefetch_neighbours(doc_id: str, key: str, page: int, dpi: int):
+    """Render the pages either side of `page` in the background; skipped when the queue is full."""
+    for p in (page + 1, page - 1):
+        if p >= 0 and _PREFETCH_SLOTS.acquire(blocking=False):
+            _PREFETCH_POOL.submit(_prefetch_page, doc_id, key, p, dpi)
+
+def _start_warm(doc_id: str, key: str):
+    cancel = threading.Event()
+    with _WARMING_LOCK:
+        _WARMING[doc_id] = cancel
+    _WARM_POOL.submit(_warm_thumbs, doc_id, key, cancel)
+
+def _cancel_warm(doc_id: str):
+    """Stop a sweep whose version is no longer the working one."""
+    with _WARMING_LOCK:
+        cancel = _WARMING.pop(doc_id, None)
+    if cancel is not None:
+        cancel.set()
+
+def _prune_render_cache(doc_id: str, doc: dict):
+    live = {_ver(k) for k in doc["versions"][-RENDER_CACHE_KEEP:]} | set(doc.get("page_tags", ()))
+    for f in (WORK_DIR / doc_id / "cache").glob("*.jpg"):
+        if f.name.split("_", 1)[0] not in live:
+            f.unlink(missing_ok=True)
 
 # ───────── Helpers ─────────
 def _allowed(filename: str) -> bool:
@@ -70,64 +490,228 @@ def _color_tuple(rgb_list):
     r, g, b = [max(0, min(255, int(c))) / 255.0 for c in rgb_list[:3]]
     return (r, g, b)
 
-def _scale_rect(rect, page_rect, viewport):
+def _scale_factors(page_rect, viewport):
+    """(sx, sy) mapping overlay pixels to PDF points; computed once per page, not per action."""
+    if not viewport:
+        viewport = {"w": page_rect.width, "h": page_rect.height}
     vx, vy = max(1, int(viewport.get("w", 1))), max(1, int(viewport.get("h", 1)))
-    sx, sy = page_rect.width / vx, page_rect.height / vy
-    x0, y0, x1, y1 = rect
-    return fitz.Rect(x0 * sx, y0 * sy, x1 * sx, y1 * sy)
-
-def _scale_point(pt, page_rect, viewport):
-    vx, vy = max(1, int(viewport.get("w", 1))), max(1, int(viewport.get("h", 1)))
-    sx, sy = page_rect.width / vx, page_rect.height / vy
-    return fitz.Point(pt[0] * sx, pt[1] * sy)
-
+    return page_rect.width / vx, page_rect.height / vy
+
+def _ink_stroke(stroke, sx, sy, page_rect):
+    """Scale and clip one polyline to the page, dropping repeated vertices.
+
+    Plain tuples: add_ink_annot wants float pairs, and this skips a Point per vertex.
+    """
+    px0, py0, px1, py1 = page_rect
+    out, last = [], None
+    for x, y in stroke:
+        p = (max(px0, min(px1, x * sx)), max(py0, min(py1, y * sy)))
+        if p != last:
+            out.append(p)
+            last = p
+    return out
+
+def _scale_point(pt, sx, sy):
+    return (pt[0] * sx, pt[1] * sy)  # PyMuPDF takes any point-like; a tuple skips the wrapper
+
+@lru_cache(maxsize=32)  # the same signature tends to come back save after save
 def _decode_data_url(data_url: str) -> bytes:
     if not data_url or "," not in data_url:
         return b""
     _, b64 = data_url.split(",", 1)
-    return base64.b64decode(b64)
-
-def _clip_rect(r: fitz.Rect, page_rect: fitz.Rect) -> fitz.Rect:
-    x0 = max(page_rect.x0, min(page_rect.x1, r.x0))
-    y0 = max(page_rect.y0, min(page_rect.y1, r.y0))
-    x1 = max(page_rect.x0, min(page_rect.x1, r.x1))
-    y1 = max(page_rect.y0, min(page_rect.y1, r.y1))
+    if pybase64 is not None:
+        return pybase64.b64decode(b64, validate=True)
+    return binascii.a2b_base64(b64)
+
+def _fit_rect(rect, sx, sy, page_rect, min_w=2.0, min_h=2.0) -> fitz.Rect:
+    """Scale an overlay rect to PDF points, clip it to the page and give it a minimum size.
+
+    Plain float math throughout; only the result becomes a fitz.Rect.
+    """
+    px0, py0, px1, py1 = page_rect
+    def clip(x0, y0, x1, y1):
+        return (max(px0, min(px1, x0)), max(py0, min(py1, y0)),
+                max(px0, min(px1, x1)), max(py0, min(py1, y1)))
+    x0, y0, x1, y1 = rect
+    x0, y0, x1, y1 = clip(x0 * sx, y0 * sy, x1 * sx, y1 * sy)
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    if x1 - x0 < min_w:
+        x0, x1 = cx - min_w / 2, cx + min_w / 2
+    if y1 - y0 < min_h:
+        y0, y1 = cy - min_h / 2, cy + min_h / 2
+    x0, y0, x1, y1 = clip(x0, y0, x1, y1)
+    if x1 <= x0 or y1 <= y0:
+        x0, y0, x1, y1 = clip(cx - min_w / 2, cy - min_h / 2, cx + min_w / 2, cy + min_h / 2)
     return fitz.Rect(x0, y0, x1, y1)
 
-def _ensure_min_rect(r: fitz.Rect, page_rect: fitz.Rect, min_w=2.0, min_h=2.0) -> fitz.Rect:
-    cx, cy = (r.x0 + r.x1) / 2, (r.y0 + r.y1) / 2
-    if r.width < min_w:
-        r.x0, r.x1 = cx - min_w / 2, cx + min_w / 2
-    if r.height < min_h:
-        r.y0, r.y1 = cy - min_h / 2, cy + min_h / 2
-    r = _clip_rect(r, page_rect)
-    if r.width <= 0 or r.height <= 0:
-        r = fitz.Rect(cx - min_w / 2, cy - min_h / 2, cx + min_w / 2, cy + min_h / 2)
-        r = _clip_rect(r, page_rect)
-    return r
-
-@app.after_request
-def add_no_cache(resp):
-    if request.path.startswith(("/thumb/", "/page/")):
-        resp.headers["Cache-Control"] = "no-store, max-age=0"
+def _ver(key: str) -> str:
+    """Short, URL-safe tag for a storage key; render URLs embed it so they never go stale."""
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+def _version_key(doc: dict, ver: str):
+    for key in reversed(doc["versions"]):
+        if _ver(key) == ver:
+            return key
+    return None
+
+def _thumb_key(doc: dict, ver: str, page: int):
+    tags = doc.get("page_tags") or ()
+    # a page's tag names its content, which the working version still has even if that version was trimmed
+    return doc["working"] if 0 <= page < len(tags) and tags[page] == ver else _version_key(doc, ver)
+
+def _immutable(resp, etag: str, public: bool = False):
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"{'public' if public else 'private'}, max-age=31536000, immutable"
     return resp
 
+# ───────── Annotation ─────────
+def _apply_action(page, page_rect, scale, a, images):
+    t = a.get("type")
+    sx, sy = scale
+
+    if t in ("highlight", "strikeout", "shape_rect", "shape_circle", "textbox", "signature", "tick", "cross"):
+        rect = _fit_rect(a["rect"], sx, sy, page_rect)
+
+    if t == "highlight":
+        try:
+            annot = page.add_highlight_annot(rect)
+            annot.set_colors(stroke=_color_tuple(a.get("color")))
+            if "opacity" in a: annot.set_opacity(float(a["opacity"]))
+            annot.update()
+        except Exception:
+            annot = page.add_rect_annot(rect)
+            annot.set_colors(stroke=None, fill=_color_tuple(a.get("color")))
+            annot.set_opacity(float(a.get("opacity", 0.35)))
+            annot.update()
+
+    elif t == "strikeout":
+        try:
+            annot = page.add_strikeout_annot(rect)
+            annot.set_colors(stroke=_color_tuple(a.get("color")))
+            if "opacity" in a: annot.set_opacity(float(a["opacity"]))
+            annot.update()
+        except Exception:
+            y = (rect.y0 + rect.y1) / 2
+            p1 = (rect.x0, y); p2 = (rect.x1, y)
+            annot = page.add_line_annot(p1, p2)
+            annot.set_border(width=float(a.get("thickness", 2)))
+            annot.set_colors(stroke=_color_tuple(a.get("color")))
+            annot.update()
+
+    elif t == "shape_rect":
+        annot = page.add_rect_annot(rect)
+        annot.set_border(width=float(a.get("thickness", 2)))
+        annot.set_colors(stroke=_color_tuple(a.get("color")))
+        annot.update()
+
+    elif t == "shape_circle":
+        annot = page.add_circle_annot(rect)
+        annot.set_border(width=float(a.get("thickness", 2)))
+        annot.set_colors(stroke=_color_tuple(a.get("color")))
+        annot.update()
+
+    elif t in ("line", "arrow"):
+        p1 = _scale_point(a["points"][0], sx, sy)
+        p2 = _scale_point(a["points"][1], sx, sy)
+        if p1 == p2:
+            p2 = (min(page_rect.x1, p2[0] + 5), min(page_rect.y1, p2[1] + 5))
+        annot = page.add_line_annot(p1, p2)
+        annot.set_border(width=float(a.get("thickness", 2)))
+        annot.set_colors(stroke=_color_tuple(a.get("color")))
+        if t == "arrow":
+            try: annot.set_line_ends(("OpenArrow", "None"))
+            except Exception: pass
+        annot.update()
+
+    elif t == "ink":
+        strokes = [_ink_stroke(stroke, sx, sy, page_rect) for stroke in a["points"]]
+        strokes = [s for s in strokes if len(s) > 1]
+        if not strokes: return False
+        annot = page.add_ink_annot(strokes)
+        annot.set_colors(stroke=_color_tuple(a.get("color")))
+        annot.set_border(width=float(a.get("thickness", 2)))
+        annot.update()
+
+    elif t == "textbox":
+        content = a.get("text", "")
+        font = a.get("font", "helv")
+        size = float(a.get("font_size", 14))
+
+        min_text_height = max(16.0, size * 1.6)
+        if rect.height < min_text_height:
+            rect = fitz.Rect(rect.x0, rect.y0, rect.x1, min(page_rect.y1, rect.y0 + min_text_height))
+
+        text_rgb = _color_tuple(a.get("color", [0, 0, 0]))
+        # Use text_color when creating the annotation (avoid set_colors(text=...))
+        annot = page.add_freetext_annot(rect, content, fontsize=size, fontname=font, text_color=text_rgb)
+        annot.set_border(width=0)
+        annot.update()
+
+    elif t == "signature":
+        # one image object per distinct signature; later placements just reference its xref
+        src = a.get("image_data_url")
+        if src in images:
+            page.insert_image(rect, xref=images[src], keep_proportion=True)
+        else:
+            img_bytes = _decode_data_url(src)
+            if not img_bytes: return False
+            images[src] = page.insert_image(rect, stream=img_bytes, keep_proportion=True)
+
+    elif t == "tick":
+        x0,y0,x1,y1 = rect.x0, rect.y0, rect.x1, rect.y1
+        pA = (x0 + (x1-x0)*0.1, y0 + (y1-y0)*0.6)
+        pB = (x0 + (x1-x0)*0.4, y1 - (y1-y0)*0.1)
+        pC = (x1 - (x1-x0)*0.1, y0 + (y1-y0)*0.15)
+        annot = page.add_polyline_annot([pA,pB,pC])
+        annot.set_colors(stroke=_color_tuple(a.get("color")))
+        annot.set_border(width=float(a.get("thickness", 2)))
+        annot.update()
+
+    elif t == "cross":
+        p1 = (rect.x0, rect.y0); p2 = (rect.x1, rect.y1)
+        p3 = (rect.x1, rect.y0); p4 = (rect.x0, rect.y1)
+        ann1 = page.add_line_annot(p1, p2); ann2 = page.add_line_annot(p3, p4)
+        for ann in (ann1, ann2):
+            ann.set_colors(stroke=_color_tuple(a.get("color")))
+            ann.set_border(width=float(a.get("thickness", 2)))
+            ann.update()
+
+    else:
+        return False
+    return True
+
+def _apply_actions(pdf, actions, viewport):
+    """Apply a save payload page by page; returns the set of pages that got something added."""
+    images, touched = {}, set()
+    # stable sort: actions keep their drawing order within a page
+    actions.sort(key=lambda a: a["page"])
+    for pno, group in groupby(actions, key=lambda a: a["page"]):
+        page = pdf[pno]
+        page_rect = page.rect
+        scale = _scale_factors(page_rect, viewport)
+        scales = {}  # actions carry the viewport they were drawn at; it rarely changes within a page
+        for a in group:  # one annot per action: strokes stay separately selectable, in drawing order
+            s = scale
+            if "viewport" in a:
+                vp = a["viewport"] or {}
+                vk = (vp.get("w"), vp.get("h"))
+                if vk not in scales:
+                    scales[vk] = _scale_factors(page_rect, vp)
+                s = scales[vk]
+            if _apply_action(page, page_rect, s, a, images):
+                touched.add(pno)
+    return touched
+
 # ───────── UI (inline) ─────────
-INDEX_HTML = r"""
-<!doctype html>
-<html lang="en">
-<head>
-  <meta charset="utf-8" />
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <title>OnePlacePDF</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet" />
-  <style>
+APP_CSS = r"""
     body { background:#0b1020; color:#e7ecff; }
     .toolbar .btn { border-radius:999px; }
     #thumbs { max-height:80vh; overflow:auto; }
     #canvasWrap { position:relative; background:#101425; padding:0; min-height:60vh; }
     #pageImg { display:block; max-width:100%; height:auto; position:relative; z-index:1; }
-    #overlay { position:absolute; left:0; top:0; pointer-events:auto; z-index:2; }
+    #commit, #overlay { position:absolute; left:0; top:0; z-index:2; }
+    #commit { pointer-events:none; }
+    #overlay { pointer-events:auto; touch-action:none; }
     .tool-active { outline:2px solid #6ea8fe; }
     .kbd { font-family: ui-monospace, SFMono-Regular, Menlo, monospace; background:#11162a; border:1px solid #2a355d; border-radius:6px; padding:1px 6px; }
     .card.bg-dark { background:#0f1428 !important; }
@@ -139,125 +723,17 @@ INDEX_HTML = r"""
       box-shadow:0 6px 16px rgba(0,0,0,.35);
     }
     #selToolbar .btn { padding:.15rem .5rem; }
-  </style>
-</head>
-<body>
-<div class="container-fluid py-3">
-  <div class="d-flex align-items-center gap-2 mb-3">
-    <h3 class="m-0 brand">OnePlacePDF</h3>
-    <input id="file" type="file" class="form-control w-auto" accept="application/pdf" />
-    <button id="btnDownload" class="btn btn-success">Download</button>
-    <button id="btnUndoServer" class="btn btn-outline-warning">Rollback (server)</button>
-    <a href="/help" target="_blank" class="btn btn-outline-info">How to use</a>
-    <a href="/shortcuts" target="_blank" class="btn btn-outline-secondary">Shortcuts</a>
-  </div>
-
-  <div class="row g-3">
-    <div class="col-3">
-      <div class="card bg-dark border-secondary">
-        <div class="card-header">Pages</div>
-        <div class="card-body" id="thumbs"></div>
-      </div>
-      <div class="small mt-3">
-        Shortcuts:
-        <span class="kbd">H</span> Highlight,
-        <span class="kbd">S</span> Strike,
-        <span class="kbd">R</span> Rect,
-        <span class="kbd">C</span> Circle,
-        <span class="kbd">L</span> Line,
-        <span class="kbd">A</span> Arrow,
-        <span class="kbd">I</span> Ink,
-        <span class="kbd">T</span> Text,
-        <span class="kbd">G</span> Signature
-        — Click an annotation to move/resize. ⌫/Del = delete. Double-click a textbox to edit.
-      </div>
-    </div>
-
-    <div class="col-9">
-      <div class="card bg-dark border-secondary mb-3">
-        <div class="card-body toolbar d-flex flex-wrap gap-2 align-items-center">
-          <button class="btn btn-light" data-tool="highlight">Highlight</button>
-          <button class="btn btn-light" data-tool="strikeout">Strikeout</button>
-          <button class="btn btn-light" data-tool="rect">Rect</button>
-          <button class="btn btn-light" data-tool="circle">Circle</button>
-          <button class="btn btn-light" data-tool="line">Line</button>
-          <button class="btn btn-light" data-tool="arrow">Arrow</button>
-          <button class="btn btn-light" data-tool="ink">Freehand</button>
-          <button class="btn btn-light" data-tool="textbox">Text Box</button>
-          <button class="btn btn-light" data-tool="tick">Tick ✓</button>
-          <button class="btn btn-light" data-tool="cross">Cross ✗</button>
-          <button class="btn btn-warning" data-tool="signature" id="btnSignature" data-bs-toggle="modal" data-bs-target="#signatureModal">Signature</button>
-
-          <div class="vr"></div>
-          <label class="small-label">Color</label>
-          <input id="color" type="color" value="#ffeb3b" class="form-control form-control-color" />
-          <label class="small-label ms-2">Thickness</label>
-          <input id="thickness" type="range" min="1" max="12" value="2" class="form-range w-25" />
-
-          <div class="vr"></div>
-          <label class="small-label">Font</label>
-          <select id="fontFamily" class="form-select form-select-sm w-auto">
-            <option value="helv" selected>Helvetica</option>
-            <option value="times">Times</option>
-            <option value="cour">Courier</option>
-          </select>
-          <label class="small-label ms-2">Size</label>
-          <input id="fontSize" type="number" min="8" max="72" step="1" value="14" class="form-control form-control-sm" style="width:80px;" />
-
-          <div class="vr"></div>
-          <button class="btn btn-primary" id="btnSave">Save Edits</button>
-          <button class="btn btn-outline-light" id="btnUndo">Undo</button>
-          <button class="btn btn-outline-light" id="btnRedo">Redo</button>
-          <div class="vr"></div>
-          <label class="small-label">Zoom</label>
-          <input id="zoom" type="range" min="0.6" max="2.5" step="0.1" value="1.2" class="form-range w-25" />
-        </div>
-      </div>
-
-      <div id="canvasWrap" class="rounded-3 shadow">
-        <img id="pageImg" src="" />
-        <canvas id="overlay"></canvas>
-
-        <!-- selection mini-toolbar -->
-        <div id="selToolbar" class="btn-group">
-          <button id="btnDup" class="btn btn-sm btn-outline-light" title="Duplicate">Duplicate</button>
-          <button id="btnDel" class="btn btn-sm btn-danger" title="Delete">Delete</button>
-        </div>
-      </div>
-    </div>
-  </div>
-</div>
-
-<!-- Signature Modal -->
-<div class="modal fade" id="signatureModal" tabindex="-1" aria-hidden="true">
-  <div class="modal-dialog modal-dialog-centered">
-    <div class="modal-content bg-dark text-light border-secondary">
-      <div class="modal-header">
-        <h5 class="modal-title">Draw Your Signature</h5>
-        <button type="button" class="btn-close btn-close-white" data-bs-dismiss="modal" aria-label="Close"></button>
-      </div>
-      <div class="modal-body">
-        <canvas id="sigPad" width="500" height="180" style="background:#fff;border:1px dashed #888;touch-action:none;"></canvas>
-        <div class="d-flex gap-2 mt-2">
-          <button id="sigClear" class="btn btn-outline-light">Clear</button>
-          <button id="sigUse" class="btn btn-success" data-bs-dismiss="modal">Use Signature</button>
-          <div class="ms-auto small text-secondary" id="sigStatus">Not set</div>
-        </div>
-        <div class="small text-secondary mt-2">After “Use Signature”, drag on the page to place it.</div>
-      </div>
-    </div>
-  </div>
-</div>
+"""
 
-<script>
+APP_JS = r"""
 (() => {
-  let docId = null, currentPage = 0, totalPages = 0, zoom = 1.2;
+  let docId = null, docVer = null, currentPage = 0, totalPages = 0, zoom = 1.2;
 
   const state = {
     tool: null, color: '#ffeb3b', thickness: 2,
     fontFamily: 'helv', fontSize: 14,
     stack: [], history: [], historyIdx: -1,
-    drawing: false, stroke: [],
+    drawing: false, stroke: [], preview: null,
     signatureDataURL: null,
     sel: null, draggingSel: false
   };
@@ -266,8 +742,13 @@ INDEX_HTML = r"""
   const toolbarBtns = [...document.querySelectorAll('[data-tool]')];
   const pageImg = el('pageImg');
   const overlay = el('overlay');
+  const commitCanvas = el('commit');
+  // a canvas hands back the same context object for its lifetime, resizes included
+  const overlayCtx = overlay.getContext('2d'), commitCtx = commitCanvas.getContext('2d');
+  let committedDirty = true, committedSel = -1;
   const canvasWrap = document.getElementById('canvasWrap');
   const selToolbar = el('selToolbar'), btnDup = el('btnDup'), btnDel = el('btnDel');
+  let selToolbarW = 0;
 
   const imgCache = new Map();
   function getImageCached(src) {
@@ -308,18 +789,20 @@ INDEX_HTML = r"""
   el('thickness').addEventListener('input', e => { state.thickness = +e.target.value; if (state.sel) { applyThicknessToSelection(); }});
   el('fontFamily').addEventListener('change', e => { state.fontFamily = e.target.value; if (state.sel) applyTextStyleToSelection(); });
   el('fontSize').addEventListener('input', e => { state.fontSize = +e.target.value; if (state.sel) applyTextStyleToSelection(); });
+  // 'input' fires per tick while dragging; 'change' marks the end of that edit
+  ['color', 'thickness', 'fontFamily', 'fontSize'].forEach(id => el(id).addEventListener('change', sealHistory));
 
   function applyColorToSelection(){
     const s = state.sel; if (!s) return; const a = state.stack[s.index];
-    if (!a) return; a.colorHex = state.color; a.color = hexToRgb(state.color); snapshot(); redrawOverlay();
+    if (!a) return; modifyAction(s.index, a => { a.colorHex = state.color; a.color = hexToRgb(state.color); }, undefined, 'color'); redrawOverlay();
   }
   function applyThicknessToSelection(){
     const s = state.sel; if (!s) return; const a = state.stack[s.index];
-    if (!a) return; a.thickness = state.thickness; snapshot(); redrawOverlay();
+    if (!a) return; modifyAction(s.index, a => { a.thickness = state.thickness; }, undefined, 'thickness'); redrawOverlay();
   }
   function applyTextStyleToSelection(){
     const s = state.sel; if (!s) return; const a = state.stack[s.index];
-    if (a && a.type === 'textbox') { a.font = state.fontFamily; a.font_size = state.fontSize; snapshot(); redrawOverlay(); }
+    if (a && a.type === 'textbox') { modifyAction(s.index, a => { a.font = state.fontFamily; a.font_size = state.fontSize; }, undefined, 'text'); redrawOverlay(); }
   }
 
   el('zoom').addEventListener('input', e => { zoom = +e.target.value; renderPage(); });
@@ -328,11 +811,11 @@ INDEX_HTML = r"""
     const f = e.target.files[0];
     if (!f) return;
     try {
-      const fd = new FormData(); fd.append('file', f);
-      const r = await fetch('/upload', { method: 'POST', body: fd });
+      const r = await fetch('/upload?name=' + encodeURIComponent(f.name),
+        { method: 'POST', body: f, headers: { 'Content-Type': 'application/pdf' } });
       const j = await parseMaybeJSON(r);
       if (!r.ok || j.error) throw new Error(j.error || 'Upload failed');
-      docId = j.doc_id;
+      docId = j.doc_id; docVer = j.ver;
       resetStacks();
       await loadThumbs();
       await renderPage(0);
@@ -340,8 +823,8 @@ INDEX_HTML = r"""
   });
 
   function resetStacks(){
-    state.stack = []; state.history = []; state.historyIdx = -1; snapshot();
-    clearSelection();
+    state.stack = []; state.history = []; state.historyIdx = -1; byPage = null;
+    invalidateCommitted(); clearSelection();
   }
 
   el('btnDownload').addEventListener('click', () => { if (docId) window.location.href = '/download/' + docId; });
@@ -351,41 +834,81 @@ INDEX_HTML = r"""
       const r = await fetch('/revert/' + docId, { method: 'POST' });
       const j = await parseMaybeJSON(r);
       if (!j.ok) throw new Error(j.error || 'Rollback failed');
-      resetStacks(); await renderPage();
+      docVer = j.ver; resetStacks(); await renderPage(); await loadThumbs();
     } catch (err) { alert('Rollback error: ' + err.message); console.error(err); }
   });
 
   el('btnUndo').addEventListener('click', () => undo());
   el('btnRedo').addEventListener('click', () => redo());
-  function snapshot() {
-    state.history = state.history.slice(0, state.historyIdx + 1);
-    state.history.push(JSON.stringify(state.stack));
+  // History holds one op per edit ({op:'add'|'remove'|'modify', index, before, after}) with only
+  // the touched item serialised, rather than a copy of the whole stack per step.
+  // Stack indices per page, so drawing and hit-testing only visit the current page's items.
+  // Appends keep it current; anything that shifts indices drops it and it is rebuilt on next use.
+  let byPage = null;
+  function pageItems(p) {
+    if (!byPage) {
+      byPage = new Map();
+      state.stack.forEach((a, i) => { let l = byPage.get(a.page); if (!l) byPage.set(a.page, l = []); l.push(i); });
+    }
+    return byPage.get(p) || [];
+  }
+
+  function recordOp(op) {
+    state.history.length = state.historyIdx + 1;
+    state.history.push(op);
     state.historyIdx = state.history.length - 1;
   }
+  function addAction(a) {
+    state.stack.push(a);
+    if (byPage) { let l = byPage.get(a.page); if (!l) byPage.set(a.page, l = []); l.push(state.stack.length - 1); }
+    recordOp({ op:'add', index: state.stack.length - 1, after: JSON.stringify(a) });
+  }
+  function removeAction(i) {
+    const [a] = state.stack.splice(i, 1); byPage = null;
+    recordOp({ op:'remove', index: i, before: JSON.stringify(a) });
+  }
+  // `merge` folds a burst of edits (a slider drag, typing a size) into one undo step until sealHistory()
+  function modifyAction(i, fn, before = JSON.stringify(state.stack[i]), merge = null) {
+    fn(state.stack[i]);
+    const after = JSON.stringify(state.stack[i]);
+    const top = state.history[state.historyIdx];
+    if (merge && top && top.merge === merge && top.index === i && state.historyIdx === state.history.length - 1) { top.after = after; return; }
+    if (after !== before) recordOp({ op:'modify', index: i, before, after, merge });
+  }
+  function sealHistory() { const top = state.history[state.historyIdx]; if (top) top.merge = null; }
   function undo() {
-    if (state.historyIdx > 0) {
-      state.historyIdx--; state.stack = JSON.parse(state.history[state.historyIdx]);
-      clearSelection(); redrawOverlay();
-    }
+    if (state.historyIdx < 0) return;
+    const h = state.history[state.historyIdx--]; byPage = null;
+    if (h.op === 'add') state.stack.splice(h.index, 1);
+    else if (h.op === 'remove') state.stack.splice(h.index, 0, JSON.parse(h.before));
+    else state.stack[h.index] = JSON.parse(h.before);
+    invalidateCommitted(); clearSelection(); redrawOverlay();
   }
   function redo() {
-    if (state.historyIdx < state.history.length - 1) {
-      state.historyIdx++; state.stack = JSON.parse(state.history[state.historyIdx]);
-      clearSelection(); redrawOverlay();
-    }
+    if (state.historyIdx >= state.history.length - 1) return;
+    const h = state.history[++state.historyIdx]; byPage = null;
+    if (h.op === 'add') state.stack.splice(h.index, 0, JSON.parse(h.after));
+    else if (h.op === 'remove') state.stack.splice(h.index, 1);
+    else state.stack[h.index] = JSON.parse(h.after);
+    invalidateCommitted(); clearSelection(); redrawOverlay();
   }
 
+  // pointer coordinates come with ~15 significant digits; 1/100 px is already far below a PDF point,
+  // and ink-heavy payloads come out less than half the size
+  const roundCoord = (k, v) => (typeof v === 'number' && !Number.isInteger(v)) ? Math.round(v * 100) / 100 : v;
+
   el('btnSave').addEventListener('click', async () => {
     if (!docId || !state.stack.length) return;
     try {
       const viewport = { w: overlay.width, h: overlay.height };
-      const payload = { actions: state.stack.map(a => ({ ...a, viewport })) };
+      // previewDataURL is a client-only copy of image_data_url; don't ship it twice
+      const payload = { viewport, actions: state.stack.map(({ previewDataURL, ...a }) => a) };
       const r = await fetch('/annotate/' + docId, {
-        method: 'POST', headers: { 'Content-Type': 'application/json', 'Accept':'application/json' }, body: JSON.stringify(payload)
+        method: 'POST', headers: { 'Content-Type': 'application/json', 'Accept':'application/json' }, body: JSON.stringify(payload, roundCoord)
       });
       const j = await parseMaybeJSON(r);
       if (!j.ok) throw new Error(j.error || 'Save failed');
-      resetStacks(); await renderPage();
+      docVer = j.ver; resetStacks(); await renderPage(); await loadThumbs();
     } catch (err) { alert('Save error: ' + err.message); console.error(err); }
   });
 
@@ -396,42 +919,70 @@ INDEX_HTML = r"""
     return { ok: false, error: text.slice(0, 300) || 'Non-JSON response', raw: text };
   }
 
+  // Thumbs load as they scroll near the sidebar's viewport and drop their decoded image once far
+  // off again (keeping their height), so a long document doesn't hold every page in memory.
+  const thumbIO = new IntersectionObserver(entries => {
+    for (const { target: img, isIntersecting } of entries) {
+      if (isIntersecting) { if (!img.getAttribute('src')) img.src = img.dataset.src; }
+      else if (img.getAttribute('src')) { img.style.minHeight = img.height + 'px'; img.removeAttribute('src'); }
+    }
+  }, { root: el('thumbs'), rootMargin: '1000px 0px' });
+
   async function loadThumbs() {
     const r = await fetch('/thumbs/' + docId);
     const j = await parseMaybeJSON(r);
     if (!r.ok || j.error) throw new Error(j.error || 'Thumbs failed');
     totalPages = j.pages;
-    const wrap = el('thumbs'); wrap.innerHTML = '';
+    const wrap = el('thumbs'); thumbIO.disconnect(); wrap.innerHTML = '';
     for (let i = 0; i < totalPages; i++) {
       const img = document.createElement('img');
-      img.src = `/thumb/${docId}/${i}`;
+      img.decoding = 'async';
+      img.style.minHeight = '120px';  // until loaded, so unloaded thumbs don't all count as on-screen
+      img.addEventListener('load', () => { img.style.minHeight = ''; });
+      // manifest URLs only change for pages a save touched, so the rest come from the browser cache
+      img.dataset.src = j.thumbs ? j.thumbs[i] : `/thumb/${docId}/${docVer}/${i}`;
       img.className = 'img-fluid mb-2 rounded';
       img.style.cursor = 'pointer';
       img.addEventListener('click', () => renderPage(i));
       wrap.appendChild(img);
+      thumbIO.observe(img);
     }
   }
 
-  function syncOverlaySize() {
-    overlay.width  = Math.max(pageImg.clientWidth  || 1, 1);
-    overlay.height = Math.max(pageImg.clientHeight || 1, 1);
+  function syncOverlaySize(w, h) {
+    overlay.width  = Math.max(Math.round(w) || 1, 1);
+    overlay.height = Math.max(Math.round(h) || 1, 1);
     overlay.style.width  = overlay.width  + 'px';
     overlay.style.height = overlay.height + 'px';
+    commitCanvas.width = overlay.width; commitCanvas.height = overlay.height;
+    commitCanvas.style.width = overlay.style.width; commitCanvas.style.height = overlay.style.height;
+    invalidateCommitted();
   }
-  window.addEventListener('resize', () => { syncOverlaySize(); redrawOverlay(); });
+  // The observer hands us the image size after layout, so nothing here forces a synchronous
+  // reflow, and it also catches size changes a window resize event wouldn't (zoom, sidebar).
+  new ResizeObserver(entries => {
+    const { width, height } = entries[entries.length - 1].contentRect;
+    if (Math.round(width) === overlay.width && Math.round(height) === overlay.height) return;
+    syncOverlaySize(width, height); redrawOverlay();
+  }).observe(pageImg);
 
   async function renderPage(p = currentPage) {
     if (docId == null) return;
     currentPage = p;
-    pageImg.src = `/page/${docId}/${currentPage}?zoom=${zoom}`;
-    await new Promise((res, rej) => { pageImg.onload = res; pageImg.onerror = () => rej(new Error('Failed to load page image')); });
-    syncOverlaySize(); redrawOverlay();
+    const url = `/page/${docId}/${docVer}/${currentPage}?zoom=${zoom}`;
+    pageImg.src = url;
+    // decode() settles once the bitmap is ready to paint, so showing it doesn't block the main thread
+    try { await pageImg.decode(); }
+    catch (e) { if (pageImg.src.endsWith(url)) throw new Error('Failed to load page image'); return; }  // else superseded
+    invalidateCommitted(); redrawOverlay();  // a size change, if any, arrives via the ResizeObserver
   }
 
   function hexToRgb(hex) { const n = parseInt(hex.slice(1), 16); return [(n>>16)&255, (n>>8)&255, n&255]; }
   const dist = (a,b)=>Math.hypot(b[0]-a[0], b[1]-a[1]);
 
-  overlay.addEventListener('mousedown', (e) => {
+  overlay.addEventListener('pointerdown', (e) => {
+    if (e.button !== 0) return;
+    overlay.setPointerCapture(e.pointerId);  // keep getting moves and the up even off the canvas
     const pt = rel(e);
     const hit = hitTestAt(pt.x, pt.y);
     if (hit) {
@@ -444,33 +995,61 @@ INDEX_HTML = r"""
     if (state.tool === 'ink') state.stroke = [[pt.x, pt.y]];
   });
 
-  overlay.addEventListener('mousemove', (e) => {
-    const pt = rel(e);
-    if (state.draggingSel && state.sel) { applyDragToSelection(pt); requestAnimationFrame(redrawOverlay); return; }
-    if (!state.drawing) { redrawOverlay(); return; }
-    if (state.tool === 'ink') { state.stroke.push([pt.x, pt.y]); requestAnimationFrame(redrawOverlay); return; }
-    redrawOverlay();
-    const ctx = overlay.getContext('2d');
-    const preview = buildActionFromDrag(state.start, [pt.x, pt.y], true);
-    if (preview) drawLocal(ctx, preview, true);
+  // Pointer events can arrive far faster than the display refreshes; draw at most once per frame.
+  // Drags and shape previews only depend on the latest point, so that is all a frame applies;
+  // ink keeps every sample.
+  let redrawQueued = false, pendingPt = null;
+  function scheduleRedraw() {
+    if (redrawQueued) return;
+    redrawQueued = true;
+    requestAnimationFrame(() => { redrawQueued = false; flushMove(); redrawOverlay(); });
+  }
+
+  function flushMove() {
+    const pt = pendingPt; if (!pt) return;
+    pendingPt = null;
+    if (state.draggingSel && state.sel) applyDragToSelection(pt);
+    else if (state.drawing) state.preview = buildActionFromDrag(state.start, [pt.x, pt.y], true);
+  }
+
+  overlay.addEventListener('pointermove', (e) => {
+    if (!(state.draggingSel && state.sel) && !state.drawing) return;
+    if (state.drawing && state.tool === 'ink') {
+      // samples the browser merged into this event; the stroke keeps them, the redraw stays once per frame
+      const cs = (e.getCoalescedEvents && e.getCoalescedEvents()) || [];
+      for (const c of (cs.length ? cs : [e])) { const p = rel(c); state.stroke.push([p.x, p.y]); }
+    } else pendingPt = rel(e);
+    scheduleRedraw();
   });
 
-  overlay.addEventListener('mouseup', (e) => {
+  overlay.addEventListener('pointerup', (e) => {
     const pt = rel(e);
-    if (state.draggingSel && state.sel) { state.draggingSel = false; snapshot(); updateSelToolbar(); return; }
+    flushMove();
+    if (state.draggingSel && state.sel) {
+      state.draggingSel = false; modifyAction(state.sel.index, () => {}, selBefore); updateSelToolbar(); return;
+    }
     if (!state.drawing) return;
-    state.drawing = false;
+    state.drawing = false; state.preview = null;
 
     if (state.tool === 'ink') {
       if (state.stroke.length > 1) {
-        state.stack.push({ type:'ink', page: currentPage, points:[state.stroke], color:hexToRgb(state.color), colorHex:state.color, thickness:state.thickness });
-        snapshot();
+        const a = { type:'ink', page: currentPage, points:[state.stroke], color:hexToRgb(state.color), colorHex:state.color, thickness:state.thickness };
+        addAction(a); commitOne(a);
       }
       state.stroke = []; redrawOverlay(); return;
     }
     const act = buildActionFromDrag(state.start, [pt.x, pt.y], false);
-    if (!act) return;
-    state.stack.push(act); snapshot(); redrawOverlay();
+    if (!act) { redrawOverlay(); return; }
+    addAction(act); commitOne(act); redrawOverlay();
+  });
+
+  // the browser or OS took the gesture over (palm rejection, system swipe): abandon it, no pointerup follows
+  overlay.addEventListener('pointercancel', () => {
+    if (state.draggingSel && state.sel && selBefore !== null) {
+      state.stack[state.sel.index] = JSON.parse(selBefore); invalidateCommitted();  // undo the partial drag
+    }
+    state.drawing = false; state.draggingSel = false; state.stroke = []; state.preview = null; pendingPt = null;
+    redrawOverlay();
   });
 
   overlay.addEventListener('dblclick', () => {
@@ -478,25 +1057,42 @@ INDEX_HTML = r"""
     const a = state.stack[s.index];
     if (a && a.type === 'textbox' && a.page === currentPage) {
       const newText = prompt('Edit text:', a.text || '');
-      if (newText !== null) { a.text = newText; snapshot(); redrawOverlay(); }
+      if (newText !== null) { modifyAction(s.index, a => { a.text = newText; }); redrawOverlay(); }
     }
   });
 
   function rel(e) { const r = overlay.getBoundingClientRect(); return { x: e.clientX - r.left, y: e.clientY - r.top }; }
 
-  function redrawOverlay() {
-    const ctx = overlay.getContext('2d');
-    ctx.clearRect(0,0,overlay.width, overlay.height);
-    for (let i=0; i<state.stack.length; i++) {
-      const a = state.stack[i]; if (a.page !== currentPage) continue;
+  // Two stacked canvases: #commit holds finished annotations and is only repainted when the
+  // stack, page or size changes; #overlay is cleared every frame and holds just the selected
+  // item, the in-progress stroke/shape and the selection handles.
+  function invalidateCommitted() { committedDirty = true; }
+
+  function redrawCommitted(skip) {
+    const ctx = commitCtx;
+    ctx.clearRect(0,0,commitCanvas.width, commitCanvas.height);
+    for (const i of pageItems(currentPage)) {
+      const a = state.stack[i]; if (i === skip) continue;
       drawLocal(ctx, a, false);
     }
+    committedDirty = false; committedSel = skip;
+  }
+
+  function commitOne(a) { if (!committedDirty) drawLocal(commitCtx, a, false); }
+
+  function redrawOverlay() {
+    const sel = (state.sel && state.sel.page === currentPage) ? state.sel.index : -1;
+    if (committedDirty || sel !== committedSel) redrawCommitted(sel);
+    const ctx = overlayCtx;
+    ctx.clearRect(0,0,overlay.width, overlay.height);
+    if (sel >= 0 && state.stack[sel]) drawLocal(ctx, state.stack[sel], false);
     if (state.drawing && state.tool === 'ink' && state.stroke.length) {
       ctx.lineWidth = state.thickness; ctx.strokeStyle = state.color;
       ctx.beginPath(); ctx.moveTo(state.stroke[0][0], state.stroke[0][1]);
       for (let i=1; i<state.stroke.length; i++) ctx.lineTo(state.stroke[i][0], state.stroke[i][1]);
       ctx.stroke();
     }
+    if (state.drawing && state.preview) drawLocal(ctx, state.preview, true);
     if (state.sel && state.sel.page === currentPage) drawSelection(ctx, state.stack[state.sel.index], state.sel);
     updateSelToolbar();
   }
@@ -547,7 +1143,7 @@ INDEX_HTML = r"""
       const r = a.rect; const img = getImageCached(a.previewDataURL);
       if (img && img.complete && img.naturalWidth) {
         ctx.drawImage(img, r[0], r[1], r[2]-r[0], r[3]-r[1]);
-      } else if (img) { img.onload = () => requestAnimationFrame(redrawOverlay); }
+      } else if (img) { img.onload = () => { invalidateCommitted(); scheduleRedraw(); }; }
 
     } else if (a.type === 'tick' || a.type === 'cross') {
       const r = a.rect;
@@ -567,12 +1163,26 @@ INDEX_HTML = r"""
     ctx.restore();
   }
 
+  // Per-font advance widths, measured once per character; lines are summed instead of re-measured.
+  const advCache = new Map();
+  function textWidth(ctx, s) {
+    let adv = advCache.get(ctx.font);
+    if (!adv) advCache.set(ctx.font, adv = new Map());
+    let w = 0;
+    for (const c of s) {
+      let cw = adv.get(c);
+      if (cw === undefined) { cw = ctx.measureText(c).width; adv.set(c, cw); }
+      w += cw;
+    }
+    return w;
+  }
+
   function wrapText(ctx, text, x, y, maxWidth, lineHeight) {
-    const words = text.split(' '); let line = '';
+    const words = text.split(' '), space = textWidth(ctx, ' '); let line = '', lineW = 0;
     for (let n = 0; n < words.length; n++) {
-      const testLine = line + words[n] + ' '; const testWidth = ctx.measureText(testLine).width;
-      if (testWidth > maxWidth && n > 0) { ctx.fillText(line, x, y); line = words[n] + ' '; y += lineHeight; }
-      else { line = testLine; }
+      const w = textWidth(ctx, words[n]) + space;
+      if (lineW + w > maxWidth && n > 0) { ctx.fillText(line, x, y); line = words[n] + ' '; lineW = w; y += lineHeight; }
+      else { line += words[n] + ' '; lineW += w; }
     }
     ctx.fillText(line, x, y);
   }
@@ -596,8 +1206,9 @@ INDEX_HTML = r"""
   function rectHandles(r){ const x0=r[0],y0=r[1],x1=r[2],y1=r[3]; return [[x0,y0],[x1,y0],[x1,y1],[x0,y1]]; }
 
   function hitTestAt(x, y) {
-    for (let i=state.stack.length-1; i>=0; i--) {
-      const a = state.stack[i]; if (a.page !== currentPage) continue;
+    const items = pageItems(currentPage);
+    for (let k=items.length-1; k>=0; k--) {
+      const i = items[k], a = state.stack[i];
       if (a.type === 'line' || a.type === 'arrow') {
         const [p1,p2] = a.points;
         if (dist([x,y],p1) <= 8) return {index:i,page:currentPage,handle:'p1'};
@@ -622,8 +1233,8 @@ INDEX_HTML = r"""
     const c2 = vx*vx + vy*vy; if (c2 <= c1) return dist(p,b);
     const t = c1 / c2; const proj=[a[0]+t*vx, a[1]+t*vy]; return dist(p, proj);
   }
-  let snapshotBeforeSel = null;
-  function snapshotStartForSel() { snapshotBeforeSel = JSON.stringify(state.stack); }
+  let selBefore = null;
+  function snapshotStartForSel() { selBefore = JSON.stringify(state.stack[state.sel.index]); }
   function clampX(v){ return Math.max(0, Math.min(overlay.width, v)); }
   function clampY(v){ return Math.max(0, Math.min(overlay.height, v)); }
   function enforceMinRect(a){
@@ -657,17 +1268,17 @@ INDEX_HTML = r"""
 
   function deleteSelected(){
     if (!state.sel) return;
-    state.stack.splice(state.sel.index,1); state.sel=null; snapshot(); redrawOverlay();
+    removeAction(state.sel.index); state.sel=null; redrawOverlay();
   }
 
   btnDel.addEventListener('click', (e)=>{ e.stopPropagation(); deleteSelected(); });
   btnDup.addEventListener('click', (e)=>{
     e.stopPropagation();
     if (!state.sel) return;
-    const a = JSON.parse(JSON.stringify(state.stack[state.sel.index]));
+    const a = structuredClone(state.stack[state.sel.index]);
     if (a.rect) a.rect = [a.rect[0]+8, a.rect[1]+8, a.rect[2]+8, a.rect[3]+8];
     if (a.points) a.points = a.points.map(p=>[p[0]+8,p[1]+8]);
-    state.stack.push(a); snapshot(); state.sel={index:state.stack.length-1,page:currentPage,handle:'move'}; redrawOverlay();
+    addAction(a); state.sel={index:state.stack.length-1,page:currentPage,handle:'move'}; redrawOverlay();
   });
 
   function updateSelToolbar(){
@@ -675,11 +1286,12 @@ INDEX_HTML = r"""
     const a = state.stack[state.sel.index]; if (!a) { selToolbar.style.display='none'; return; }
     const r = a.rect ? a.rect : [ Math.min(a.points[0][0], a.points[1][0]), Math.min(a.points[0][1], a.points[1][1]),
                                   Math.max(a.points[0][0], a.points[1][0]), Math.max(a.points[0][1], a.points[1][1]) ];
-    const left = Math.max(0, Math.min(overlay.width - selToolbar.offsetWidth, r[0]));
+    const left = Math.max(0, Math.min(overlay.width - selToolbarW, r[0]));
     const top  = Math.max(0, r[1] - 36);
     selToolbar.style.left = left + 'px';
     selToolbar.style.top  = top + 'px';
     selToolbar.style.display = 'block';
+    if (!selToolbarW) selToolbarW = selToolbar.offsetWidth;  // measure once, not on every redraw
   }
 
   function buildActionFromDrag(p1, p2, preview) {
@@ -724,233 +1336,393 @@ INDEX_HTML = r"""
   document.getElementById('sigClear').addEventListener('click',()=>{ sigCtx.clearRect(0,0,sigPad.width,sigPad.height); document.getElementById('sigStatus').textContent='Not set'; state.signatureDataURL=null; });
   document.getElementById('sigUse').addEventListener('click',()=>{ state.signatureDataURL=sigPad.toDataURL('image/png'); getImageCached(state.signatureDataURL); document.getElementById('sigStatus').textContent='Signature saved'; state.tool='signature'; toolbarBtns.forEach(x=>x.classList.remove('tool-active')); document.querySelector('[data-tool="signature"]')?.classList.add('tool-active');});
 
-  function syncOverlaySize(){ overlay.width=Math.max(pageImg.clientWidth||1,1); overlay.height=Math.max(pageImg.clientHeight||1,1); overlay.style.width=overlay.width+'px'; overlay.style.height=overlay.height+'px'; }
-  window.addEventListener('resize',syncOverlaySize);
-
 })();
-</script>
+"""
+
+INDEX_HTML = r"""
+<!doctype html>
+<html lang="en">
+<head>
+  <meta charset="utf-8" />
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <title>OnePlacePDF</title>
+  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet" />
+  <link href="__APP_CSS__" rel="stylesheet" />
+</head>
+<body>
+<div class="container-fluid py-3">
+  <div class="d-flex align-items-center gap-2 mb-3">
+    <h3 class="m-0 brand">OnePlacePDF</h3>
+    <input id="file" type="file" class="form-control w-auto" accept="application/pdf" />
+    <button id="btnDownload" class="btn btn-success">Download</button>
+    <button id="btnUndoServer" class="btn btn-outline-warning">Rollback (server)</button>
+    <a href="/help" target="_blank" class="btn btn-outline-info">How to use</a>
+    <a href="/shortcuts" target="_blank" class="btn btn-outline-secondary">Shortcuts</a>
+  </div>
+
+  <div class="row g-3">
+    <div class="col-3">
+      <div class="card bg-dark border-secondary">
+        <div class="card-header">Pages</div>
+        <div class="card-body" id="thumbs"></div>
+      </div>
+      <div class="small mt-3">
+        Shortcuts:
+        <span class="kbd">H</span> Highlight,
+        <span class="kbd">S</span> Strike,
+        <span class="kbd">R</span> Rect,
+        <span class="kbd">C</span> Circle,
+        <span class="kbd">L</span> Line,
+        <span class="kbd">A</span> Arrow,
+        <span class="kbd">I</span> Ink,
+        <span class="kbd">T</span> Text,
+        <span class="kbd">G</span> Signature
+        — Click an annotation to move/resize. ⌫/Del = delete. Double-click a textbox to edit.
+      </div>
+    </div>
+
+    <div class="col-9">
+      <div class="card bg-dark border-secondary mb-3">
+        <div class="card-body toolbar d-flex flex-wrap gap-2 align-items-center">
+          <button class="btn btn-light" data-tool="highlight">Highlight</button>
+          <button class="btn btn-light" data-tool="strikeout">Strikeout</button>
+          <button class="btn btn-light" data-tool="rect">Rect</button>
+          <button class="btn btn-light" data-tool="circle">Circle</button>
+          <button class="btn btn-light" data-tool="line">Line</button>
+          <button class="btn btn-light" data-tool="arrow">Arrow</button>
+          <button class="btn btn-light" data-tool="ink">Freehand</button>
+          <button class="btn btn-light" data-tool="textbox">Text Box</button>
+          <button class="btn btn-light" data-tool="tick">Tick ✓</button>
+          <button class="btn btn-light" data-tool="cross">Cross ✗</button>
+          <button class="btn btn-warning" data-tool="signature" id="btnSignature" data-bs-toggle="modal" data-bs-target="#signatureModal">Signature</button>
+
+          <div class="vr"></div>
+          <label class="small-label">Color</label>
+          <input id="color" type="color" value="#ffeb3b" class="form-control form-control-color" />
+          <label class="small-label ms-2">Thickness</label>
+          <input id="thickness" type="range" min="1" max="12" value="2" class="form-range w-25" />
+
+          <div class="vr"></div>
+          <label class="small-label">Font</label>
+          <select id="fontFamily" class="form-select form-select-sm w-auto">
+            <option value="helv" selected>Helvetica</option>
+            <option value="times">Times</option>
+            <option value="cour">Courier</option>
+          </select>
+          <label class="small-label ms-2">Size</label>
+          <input id="fontSize" type="number" min="8" max="72" step="1" value="14" class="form-control form-control-sm" style="width:80px;" />
+
+          <div class="vr"></div>
+          <button class="btn btn-primary" id="btnSave">Save Edits</button>
+          <button class="btn btn-outline-light" id="btnUndo">Undo</button>
+          <button class="btn btn-outline-light" id="btnRedo">Redo</button>
+          <div class="vr"></div>
+          <label class="small-label">Zoom</label>
+          <input id="zoom" type="range" min="0.6" max="2.5" step="0.1" value="1.2" class="form-range w-25" />
+        </div>
+      </div>
+
+      <div id="canvasWrap" class="rounded-3 shadow">
+        <img id="pageImg" src="" />
+        <canvas id="commit"></canvas>
+        <canvas id="overlay"></canvas>
+
+        <!-- selection mini-toolbar -->
+        <div id="selToolbar" class="btn-group">
+          <button id="btnDup" class="btn btn-sm btn-outline-light" title="Duplicate">Duplicate</button>
+          <button id="btnDel" class="btn btn-sm btn-danger" title="Delete">Delete</button>
+        </div>
+      </div>
+    </div>
+  </div>
+</div>
+
+<!-- Signature Modal -->
+<div class="modal fade" id="signatureModal" tabindex="-1" aria-hidden="true">
+  <div class="modal-dialog modal-dialog-centered">
+    <div class="modal-content bg-dark text-light border-secondary">
+      <div class="modal-header">
+        <h5 class="modal-title">Draw Your Signature</h5>
+        <button type="button" class="btn-close btn-close-white" data-bs-dismiss="modal" aria-label="Close"></button>
+      </div>
+      <div class="modal-body">
+        <canvas id="sigPad" width="500" height="180" style="background:#fff;border:1px dashed #888;touch-action:none;"></canvas>
+        <div class="d-flex gap-2 mt-2">
+          <button id="sigClear" class="btn btn-outline-light">Clear</button>
+          <button id="sigUse" class="btn btn-success" data-bs-dismiss="modal">Use Signature</button>
+          <div class="ms-auto small text-secondary" id="sigStatus">Not set</div>
+        </div>
+        <div class="small text-secondary mt-2">After “Use Signature”, drag on the page to place it.</div>
+      </div>
+    </div>
+  </div>
+</div>
+
+<script src="__APP_JS__"></script>
 <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
 </body>
 </html>
 """
 
 # ───────── Routes ─────────
+ASSETS = {}  # {"app.<sha1>.js": ((raw, gzipped), mimetype)}
+
+def _precompress(data: bytes):
+    return data, gzip.compress(data, compresslevel=9, mtime=0)
+
+def _send_static(bodies, mimetype: str) -> Response:
+    """Send a (raw, gzipped) pair, picking the gzip copy when the client takes it."""
+    raw, gz = bodies
+    if "gzip" in request.accept_encodings:
+        resp = Response(gz, mimetype=mimetype)
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(raw, mimetype=mimetype)
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+def _asset(name: str, body: str, mimetype: str) -> str:
+    """Register an inline asset under a content-hashed name and return its URL."""
+    stem, ext = name.rsplit(".", 1)
+    data = body.encode("utf-8")
+    fname = f"{stem}.{hashlib.sha1(data).hexdigest()[:12]}.{ext}"
+    ASSETS[fname] = (_precompress(data), mimetype)
+    return f"/assets/{fname}"
+
+# The inline pages have no template variables, so they are encoded (and gzipped) once and sent as-is.
+_INDEX_BODY = _precompress(INDEX_HTML
+                           .replace("__APP_CSS__", _asset("app.css", APP_CSS, "text/css"))
+                           .replace("__APP_JS__", _asset("app.js", APP_JS, "text/javascript"))
+                           .encode("utf-8"))
+
 @app.get("/")
 def index():
-    return render_template_string(INDEX_HTML)
+    return _send_static(_INDEX_BODY, "text/html")
+
+@app.get("/assets/<name>")
+def asset(name):
+    if name not in ASSETS:
+        return jsonify({"error": "not found"}), 404
+    if name in request.if_none_match:
+        return _immutable(Response(status=304), name, public=True)
+    bodies, mimetype = ASSETS[name]
+    return _immutable(_send_static(bodies, mimetype), name, public=True)
 
 HELP_HTML = r"""<!doctype html><title>Mini PDF Editor — Help</title><body style="background:#0b1020;color:#e7ecff;font-family:system-ui,Segoe UI,Arial;padding:24px"><h2>How to use</h2><ol><li>Upload a PDF.</li><li>Choose a tool then drag on the page.</li><li>Click an item to select. Use the small <b>Delete / Duplicate</b> toolbar by the selection, or press <b>Delete</b>.</li><li>Undo/Redo at any time. Save to write into the PDF. Download.</li><li>Server rollback restores the previous saved version.</li></ol><p><a href="/" style="color:#9cf">Back to editor</a></p></body>"""
 
 SHORTCUTS_HTML = r"""<!doctype html><title>Shortcuts</title><body style="background:#0b1020;color:#e7ecff;font-family:system-ui,Segoe UI,Arial;padding:24px"><h2>Keyboard shortcuts</h2><ul><li>H/S/R/C/L/A/I/T/G — select tool</li><li>Ctrl/⌘+Z Undo, Ctrl/⌘+Y Redo</li><li>Delete/Backspace — delete selected</li><li>Esc — clear selection</li></ul><p><a href="/" style="color:#9cf">Back to editor</a></p></body>"""
 
+_HELP_BODY = HELP_HTML.encode("utf-8")
+_SHORTCUTS_BODY = SHORTCUTS_HTML.encode("utf-8")
+
 @app.get("/help")
 def help_page():
-    return render_template_string(HELP_HTML)
+    return Response(_HELP_BODY, mimetype="text/html")
 
 @app.get("/shortcuts")
 def shortcuts_page():
-    return render_template_string(SHORTCUTS_HTML)
+    return Response(_SHORTCUTS_BODY, mimetype="text/html")
+
+def _discard_upload(doc_id: str, *keys):
+    """Remove what a failed upload stored; without a meta.json nothing would ever reference it."""
+    for key in set(keys):
+        Storage.delete(key)
+    if not USE_S3:
+        shutil.rmtree(WORK_DIR / doc_id, ignore_errors=True)
 
 @app.post("/upload")
 def upload():
-    f = request.files.get("file")
-    if not f or not _allowed(f.filename):
+    if request.mimetype == "application/pdf":  # raw body: skips the multipart parse and its temp-file copy
+        name, stream = request.args.get("name", ""), request.stream
+    else:
+        f = request.files.get("file")
+        name, stream = (f.filename, f.stream) if f else ("", None)
+    if stream is None or not _allowed(name):
         return jsonify({"error": "Please upload a PDF file"}), 400
-    filename = secure_filename(f.filename)
+    filename = secure_filename(name)
     doc_id = str(uuid.uuid4())
     original = f"{doc_id}/original.pdf"
-    Storage.save(f.read(), original)
-    working = f"{doc_id}/working.pdf"
-    Storage.save(Storage.get(original), working)
-    DOCS[doc_id] = {
+    try:
+        Storage.save_stream(stream, original)
+    except Exception:  # client went away or the body ran past MAX_CONTENT_LENGTH
+        _discard_upload(doc_id, original)
+        raise
+    working = Storage.link(original, f"{doc_id}/working.pdf")
+    try:
+        with _cached_pdf(working) as pdf:
+            n = len(pdf)
+    except fitz.FileDataError:  # named .pdf but isn't one
+        _discard_upload(doc_id, original, working)
+        return jsonify({"error": "Please upload a PDF file"}), 400
+    _save_doc(doc_id, {
         "name": filename,
         "original": original,
         "working": working,
         "versions": [working],
+        "page_tags": [_ver(working)] * n,  # per page: version tag of its last change
         "created": datetime.utcnow().isoformat(),
-    }
-    return jsonify({"doc_id": doc_id})
+    })
+    _start_warm(doc_id, working)
+    return jsonify({"doc_id": doc_id, "ver": _ver(working)})
 
 @app.get("/thumbs/<doc_id>")
 def thumbs(doc_id):
-    if doc_id not in DOCS:
+    doc = _load_doc(doc_id, fresh=USE_S3)  # fetched right after saves, which may have run on another worker
+    if doc is None:
         return jsonify({"error": "doc not found"}), 404
-    pdf = fitz.open(stream=Storage.get(DOCS[doc_id]["working"]), filetype="pdf")
-    return jsonify({"pages": len(pdf)})
-
-@app.get("/thumb/<doc_id>/<int:page>")
-def thumb(doc_id, page):
-    if doc_id not in DOCS:
+    if "page_tags" not in doc:  # uploaded before page tags existed: count once, then it's metadata
+        with _doc_lock(doc_id):
+            doc = _load_doc(doc_id, fresh=True)
+            if doc is None:  # gone or unreadable since the first load
+                return jsonify({"error": "doc not found"}), 404
+            if "page_tags" not in doc:
+                with _cached_pdf(doc["working"]) as pdf:
+                    doc = dict(doc, page_tags=[_ver(doc["working"])] * len(pdf))
+                _save_doc(doc_id, doc)
+    tags = doc["page_tags"]
+    return jsonify({"pages": len(tags), "thumbs": [f"/thumb/{doc_id}/{t}/{i}" for i, t in enumerate(tags)]})
+
+@app.get("/thumb/<doc_id>/<ver>/<int:page>")
+def thumb(doc_id, ver, page):
+    doc = _load_doc(doc_id)
+    if doc is None:
         return jsonify({"error": "doc not found"}), 404
-    pdf = fitz.open(stream=Storage.get(DOCS[doc_id]["working"]), filetype="pdf")
-    if not (0 <= page < len(pdf)):
+    etag = f"{ver}-{page}-w{THUMB_WIDTH}"
+    if etag in request.if_none_match:
+        return _immutable(Response(status=304), etag)
+    key = _thumb_key(doc, ver, page)
+    if key is None and USE_S3:  # possibly saved by another worker since we cached the record
+        key = _thumb_key(_load_doc(doc_id, fresh=True) or doc, ver, page)
+    if key is None:
+        return jsonify({"error": "version not found"}), 404
+    path = _render_cached(doc_id, key, page, THUMB_QUALITY, width=THUMB_WIDTH, tag=ver)
+    if path is None:
         return jsonify({"error": "bad page"}), 400
-    pix = pdf[page].get_pixmap(dpi=120)
-    return send_file(io.BytesIO(pix.tobytes("png")), mimetype="image/png")
+    return _immutable(send_file(path, mimetype="image/jpeg", etag=False), etag)
 
-@app.get("/page/<doc_id>/<int:page>")
-def page_png(doc_id, page):
-    if doc_id not in DOCS:
+@app.get("/page/<doc_id>/<ver>/<int:page>")
+def page_png(doc_id, ver, page):
+    doc = _load_doc(doc_id)
+    if doc is None:
         return jsonify({"error": "doc not found"}), 404
+    key = _version_key(doc, ver)
+    if key is None and USE_S3:  # possibly saved by another worker since we cached the record
+        key = _version_key(_load_doc(doc_id, fresh=True) or doc, ver)
+    if key is None:
+        return jsonify({"error": "version not found"}), 404
     zoom = float(request.args.get("zoom", "1.0"))
     dpi = max(72, min(300, int(144 * zoom)))
-    pdf = fitz.open(stream=Storage.get(DOCS[doc_id]["working"]), filetype="pdf")
-    if not (0 <= page < len(pdf)):
+    etag = f"{ver}-{page}-{dpi}"
+    if etag in request.if_none_match:
+        return _immutable(Response(status=304), etag)
+    # JPEG encodes far faster than PNG deflate for page renders; previews are lossy-OK
+    path = _render_cached(doc_id, key, page, PAGE_QUALITY, dpi=dpi)
+    if path is None:
         return jsonify({"error": "bad page"}), 400
-    mat = fitz.Matrix(dpi / 72.0, dpi / 72.0)
-    pix = pdf[page].get_pixmap(matrix=mat, alpha=False)
-    return send_file(io.BytesIO(pix.tobytes("png")), mimetype="image/png")
+    _prefetch_neighbours(doc_id, key, page, dpi)
+    return _immutable(send_file(path, mimetype="image/jpeg", etag=False), etag)
 
 @app.post("/annotate/<doc_id>")
 def annotate(doc_id):
     try:
-        if doc_id not in DOCS:
-            return jsonify({"ok": False, "error": "doc not found"}), 404
-        data = request.get_json(force=True, silent=False) or {}
+        # parse straight from the stream; the raw body isn't kept around next to the parsed dict
+        data = app.json.loads(request.get_data(cache=False) or b"{}") or {}
         actions = data.get("actions", [])
-        if not actions:
-            return jsonify({"ok": True, "message": "nothing to do"})
-        pdf = fitz.open(stream=Storage.get(DOCS[doc_id]["working"]), filetype="pdf")
-
-        for a in actions:
-            t = a.get("type")
-            page = pdf[a["page"]]
-            page_rect = page.rect
-            viewport = a.get("viewport", {"w": page_rect.width, "h": page_rect.height})
-
-            if t in ("highlight", "strikeout", "shape_rect", "shape_circle", "textbox", "signature", "tick", "cross"):
-                rect = _scale_rect(a["rect"], page_rect, viewport)
-                rect = _ensure_min_rect(_clip_rect(rect, page_rect), page_rect, min_w=2.0, min_h=2.0)
-
-            if t == "highlight":
+        viewport = data.get("viewport")  # sent once per payload; per-action values still win
+        with _doc_lock(doc_id):
+            doc = _load_doc(doc_id, fresh=True)
+            if doc is None:
+                return jsonify({"ok": False, "error": "doc not found"}), 404
+            if not actions:
+                return jsonify({"ok": True, "message": "nothing to do", "ver": _ver(doc["working"])})
+            old_key = doc["working"]
+            new_key = f"{doc_id}/{uuid.uuid4().hex}.pdf"
+            src = Storage.path(old_key)
+            if src is not None:
+                # local disk: copy the working file and append only the new objects to the copy
+                dst = Storage.path(new_key)
+                _fast_copy(src, dst)  # a reflink where supported: the appended save is all that hits disk
+                full = None
                 try:
-                    annot = page.add_highlight_annot(rect)
-                    annot.set_colors(stroke=_color_tuple(a.get("color")))
-                    if "opacity" in a: annot.set_opacity(float(a["opacity"]))
-                    annot.update()
+                    with fitz.open(str(dst)) as pdf:
+                        touched = _apply_actions(pdf, actions, viewport)
+                        if touched and pdf.can_save_incrementally():
+                            pdf.save(str(dst), incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                        elif touched:  # repaired on open, so it needs a full rewrite
+                            full = pdf.tobytes(**PDF_SAVE_OPTS)
+                    if full is not None:
+                        Storage.save(full, new_key)
+                    elif not touched:
+                        dst.unlink()
                 except Exception:
-                    annot = page.add_rect_annot(rect)
-                    annot.set_colors(stroke=None, fill=_color_tuple(a.get("color")))
-                    annot.set_opacity(float(a.get("opacity", 0.35)))
-                    annot.update()
-
-            elif t == "strikeout":
-                try:
-                    annot = page.add_strikeout_annot(rect)
-                    annot.set_colors(stroke=_color_tuple(a.get("color")))
-                    if "opacity" in a: annot.set_opacity(float(a["opacity"]))
-                    annot.update()
-                except Exception:
-                    y = (rect.y0 + rect.y1) / 2
-                    p1 = fitz.Point(rect.x0, y); p2 = fitz.Point(rect.x1, y)
-                    annot = page.add_line_annot(p1, p2)
-                    annot.set_border(width=float(a.get("thickness", 2)))
-                    annot.set_colors(stroke=_color_tuple(a.get("color")))
-                    annot.update()
-
-            elif t == "shape_rect":
-                annot = page.add_rect_annot(rect)
-                annot.set_border(width=float(a.get("thickness", 2)))
-                annot.set_colors(stroke=_color_tuple(a.get("color")))
-                annot.update()
-
-            elif t == "shape_circle":
-                annot = page.add_circle_annot(rect)
-                annot.set_border(width=float(a.get("thickness", 2)))
-                annot.set_colors(stroke=_color_tuple(a.get("color")))
-                annot.update()
-
-            elif t in ("line", "arrow"):
-                p1 = _scale_point(a["points"][0], page_rect, viewport)
-                p2 = _scale_point(a["points"][1], page_rect, viewport)
-                if p1 == p2:
-                    p2 = fitz.Point(min(page_rect.x1, p2.x + 5), min(page_rect.y1, p2.y + 5))
-                annot = page.add_line_annot(p1, p2)
-                annot.set_border(width=float(a.get("thickness", 2)))
-                annot.set_colors(stroke=_color_tuple(a.get("color")))
-                if t == "arrow":
-                    try: annot.set_line_ends(("OpenArrow", "None"))
-                    except Exception: pass
-                annot.update()
-
-            elif t == "ink":
-                strokes = [[_scale_point(pt, page_rect, viewport) for pt in stroke] for stroke in a["points"]]
-                strokes = [s for s in strokes if len(s) > 1]
-                if not strokes: continue
-                annot = page.add_ink_annot(strokes)
-                annot.set_colors(stroke=_color_tuple(a.get("color")))
-                annot.set_border(width=float(a.get("thickness", 2)))
-                annot.update()
-
-            elif t == "textbox":
-                content = a.get("text", "")
-                font = a.get("font", "helv")
-                size = float(a.get("font_size", 14))
-
-                min_text_height = max(16.0, size * 1.6)
-                if rect.height < min_text_height:
-                    rect = fitz.Rect(rect.x0, rect.y0, rect.x1, min(page_rect.y1, rect.y0 + min_text_height))
-
-                text_rgb = _color_tuple(a.get("color", [0, 0, 0]))
-                # Use text_color when creating the annotation (avoid set_colors(text=...))
-                annot = page.add_freetext_annot(rect, content, fontsize=size, fontname=font, text_color=text_rgb)
-                annot.set_border(width=0)
-                annot.update()
-
-            elif t == "signature":
-                img_bytes = _decode_data_url(a.get("image_data_url"))
-                if img_bytes:
-                    page.insert_image(rect, stream=img_bytes, keep_proportion=True)
-
-            elif t == "tick":
-                x0,y0,x1,y1 = rect.x0, rect.y0, rect.x1, rect.y1
-                pA = fitz.Point(x0 + (x1-x0)*0.1, y0 + (y1-y0)*0.6)
-                pB = fitz.Point(x0 + (x1-x0)*0.4, y1 - (y1-y0)*0.1)
-                pC = fitz.Point(x1 - (x1-x0)*0.1, y0 + (y1-y0)*0.15)
-                annot = page.add_polyline_annot([pA,pB,pC])
-                annot.set_colors(stroke=_color_tuple(a.get("color")))
-                annot.set_border(width=float(a.get("thickness", 2)))
-                annot.update()
-
-            elif t == "cross":
-                p1 = fitz.Point(rect.x0, rect.y0); p2 = fitz.Point(rect.x1, rect.y1)
-                p3 = fitz.Point(rect.x1, rect.y0); p4 = fitz.Point(rect.x0, rect.y1)
-                ann1 = page.add_line_annot(p1, p2); ann2 = page.add_line_annot(p3, p4)
-                for ann in (ann1, ann2):
-                    ann.set_colors(stroke=_color_tuple(a.get("color")))
-                    ann.set_border(width=float(a.get("thickness", 2)))
-                    ann.update()
-
-        out = io.BytesIO()
-        pdf.save(out)
-        out.seek(0)
-        new_key = f"{doc_id}/{uuid.uuid4().hex}.pdf"
-        Storage.save(out.read(), new_key)
-        DOCS[doc_id]["working"] = new_key
-        DOCS[doc_id]["versions"].append(new_key)
-        return jsonify({"ok": True, "version": len(DOCS[doc_id]['versions'])})
+                    dst.unlink(missing_ok=True)
+                    raise
+            else:
+                # S3: edit a private handle on the spooled copy; the cached one keeps serving old-version renders
+                with fitz.open(str(Storage.spool(old_key))) as pdf:
+                    touched = _apply_actions(pdf, actions, viewport)
+                    if touched:
+                        Storage.save_pdf(pdf, new_key)
+            if not touched:  # every action was a no-op; don't write an identical version
+                return jsonify({"ok": True, "noop": True, "version": len(doc["versions"]), "ver": _ver(old_key)})
+            _cancel_warm(doc_id)
+            doc = _doc_copy(doc)
+            doc["working"] = new_key
+            doc["versions"].append(new_key)
+            tags = doc.get("page_tags")
+            if tags is not None:  # only the pages this save touched get a new thumbnail URL
+                doc["page_prev"][new_key] = [[p, tags[p]] for p in sorted(touched)]
+                for p in touched:
+                    tags[p] = _ver(new_key)
+            dropped = []
+            while len(doc["versions"]) > MAX_VERSIONS:
+                dropped.append(doc["versions"].pop(0))
+                doc["page_prev"].pop(dropped[-1], None)
+            _save_doc(doc_id, doc)
+            for key in dropped:
+                _drop_version(doc, key)
+            _prune_render_cache(doc_id, doc)
+            _shrink_store()
+            return jsonify({"ok": True, "version": len(doc['versions']), "ver": _ver(new_key)})
     except Exception as e:
         app.logger.error("Annotate failed: %s\n%s", e, traceback.format_exc())
         return jsonify({"ok": False, "error": str(e)}), 400
 
 @app.post("/revert/<doc_id>")
 def revert(doc_id):
-    if doc_id not in DOCS:
-        return jsonify({"ok": False, "error": "doc not found"}), 404
-    vers = DOCS[doc_id]["versions"]
-    if len(vers) < 2:
-        return jsonify({"ok": False, "error": "no previous version"}), 400
-    vers.pop()
-    DOCS[doc_id]["working"] = vers[-1]
-    return jsonify({"ok": True, "version": len(vers)})
+    with _doc_lock(doc_id):
+        doc = _load_doc(doc_id, fresh=True)
+        if doc is None:
+            return jsonify({"ok": False, "error": "doc not found"}), 404
+        vers = doc["versions"]
+        if len(vers) < 2:
+            return jsonify({"ok": False, "error": "no previous version"}), 400
+        _cancel_warm(doc_id)
+        doc = _doc_copy(doc)
+        vers = doc["versions"]
+        dropped = vers.pop()
+        for p, tag in doc["page_prev"].pop(dropped, []):
+            doc["page_tags"][p] = tag
+        doc["working"] = vers[-1]
+        _save_doc(doc_id, doc)
+        _drop_version(doc, dropped)
+        _prune_render_cache(doc_id, doc)
+        return jsonify({"ok": True, "version": len(vers), "ver": _ver(vers[-1])})
 
 @app.get("/download/<doc_id>")
 def download(doc_id):
-    if doc_id not in DOCS:
+    doc = _load_doc(doc_id, fresh=USE_S3)
+    if doc is None:
         return jsonify({"error": "doc not found"}), 404
-    data = Storage.get(DOCS[doc_id]["working"])
-    return send_file(io.BytesIO(data), mimetype="application/pdf",
-                     as_attachment=True, download_name=DOCS[doc_id]["name"])
+    if USE_S3:
+        # let the client pull straight from S3 instead of proxying the bytes
+        url = s3.generate_presigned_url("get_object", ExpiresIn=300, Params={
+            "Bucket": S3_BUCKET, "Key": doc["working"],
+            "ResponseContentDisposition": f'attachment; filename="{doc["name"]}"',
+        })
+        return redirect(url)
+    return send_from_directory(WORK_DIR, doc["working"], mimetype="application/pdf",
+                               as_attachment=True, download_name=doc["name"])
 
 @app.get("/health")
 def health():